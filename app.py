@@ -1,14 +1,9 @@
 import streamlit as st
 import polars as pl
 import sqlite3
-import pandas as pd
 import io
-import os 
-import re
-import tempfile
-import uuid 
 import zipfile
-from datetime import datetime
+from datetime import date
 
 # ==============================================================================
 # 1. CONFIGURACIÓN Y CONSTANTES
@@ -22,6 +17,9 @@ MONTH_MAPPING = {
     'sep': 9, 'sept': 9, 'oct': 10, 'nov': 11, 'dic': 12
 }
 
+# Fechas del tipo '15 jun 2023' (día, mes abreviado, año)
+FECHA_REGEX = r'^(\d{1,2})\s*([a-z]+)\s*(\d{4})'
+
 # Mapeo específico para archivos ODS (Columna X)
 ODS_ESTADO_MAP = {
     '+': 'cargado',
@@ -34,6 +32,7 @@ ODS_ESTADO_MAP = {
 TRUE_VALUES = {'1', 't', 'true', 'si', 's'} 
 ESTADOS = ('cargado', 'pendiente', 'revisar', 'otro distrito')
 FILTRO_OPTIONS = ["Todos los registros"] + list(ESTADOS) # Opciones de filtro de vista
+ESTADO_ENUM = pl.Enum(ESTADOS)  # Diccionario fijo: 1 byte por fila y filtros por entero
 
 class ColumnMapper:
     def __init__(self, mapping: dict):
@@ -60,14 +59,30 @@ CSV_TO_DB_MAPPING = {
 mapper = ColumnMapper(CSV_TO_DB_MAPPING)
 
 FINAL_SCHEMA = {
-    'nro_cli': pl.Int64,
-    'nro_med': pl.Int64,
+    'nro_cli': pl.UInt32,
+    'nro_med': pl.UInt32,
     'usuario': pl.Utf8,
     'domicilio': pl.Utf8,
-    'normalizado': pl.Int64, 
-    'fecha_alta': pl.Utf8, 
-    'fecha_intervencion': pl.Utf8,
-    'estado': pl.Utf8
+    'normalizado': pl.Boolean, 
+    'fecha_alta': pl.Date, 
+    'fecha_intervencion': pl.Date,
+    'estado': ESTADO_ENUM
+}
+
+# Tipos con los que se persiste en SQLite/CSV: fechas como texto ISO y el flag como 0/1
+SQLITE_SCHEMA = {**FINAL_SCHEMA, 'normalizado': pl.Int64, 'fecha_alta': pl.Utf8, 'fecha_intervencion': pl.Utf8, 'estado': pl.Utf8}
+
+# Tipos de lectura del CSV de origen: evita la inferencia (el resto de columnas queda como texto).
+# Los ids van como Float64 porque las planillas suelen exportarlos como '1.0'; el cast final los pasa a entero
+CSV_SCHEMA = {
+    'NROCLI': pl.Float64,
+    'NUMERO_MEDIDOR': pl.Float64,
+    'FULLNAME': pl.Utf8,
+    'DOMICILIO_COMERCIAL': pl.Utf8,
+    'NORMALIZADO': pl.Utf8,
+    'FECHA_ALTA': pl.Utf8,
+    'FECHA_INTERVENCION': pl.Utf8,
+    'ESTADO': pl.Utf8
 }
 
 ODS_SCHEMA = {
@@ -80,146 +95,173 @@ ODS_SCHEMA = {
     'FECHA INTERVENCION': pl.Utf8
 }
 
+ODS_TO_DB_MAPPING = {
+    'NRO CLI': 'nro_cli',
+    'NRO MED': 'nro_med',
+    'USUARIO': 'usuario',
+    'DOMICILIO': 'domicilio',
+    'N': 'normalizado',
+    'FECHA INTERVENCION': 'fecha_intervencion'
+}
+
 # ==============================================================================
 # 2. FUNCIONES DE LÓGICA
 # ==============================================================================
 
-def normalizar_fecha(fecha_str):
-    if fecha_str is None or str(fecha_str).lower() in ['none', 'nan', '']:
-        return datetime.now().strftime(DATE_FORMAT)
-    fs = str(fecha_str).lower().replace('.', '').strip()
-    try:
-        match = re.match(r'(\d{1,2})\s*([a-z]+)\s*(\d{4})', fs)
-        if match:
-            d, m_abbr, y = match.groups()
-            m_num = MONTH_MAPPING.get(m_abbr)
-            if m_num: return f"{y}-{m_num:02d}-{int(d):02d}"
-        return fs 
-    except:
-        return datetime.now().strftime(DATE_FORMAT)
+def normalizar_fecha(col: str, hoy: date) -> pl.Expr:
+    """Expresión vectorizada a pl.Date: '15 jun. 2023' -> 2023-06-15; vacíos -> hoy."""
+    crudo = pl.col(col).cast(pl.Utf8)
+    fs = crudo.str.to_lowercase().str.replace_all('.', '', literal=True).str.strip_chars()
+    partes = fs.str.extract_groups(FECHA_REGEX)
+    m_num = partes.struct[1].replace_strict(MONTH_MAPPING, default=None, return_dtype=pl.Utf8)
+    iso = pl.format("{}-{}-{}", partes.struct[2], m_num.str.zfill(2), partes.struct[0].str.zfill(2))
+    return (
+        pl.when(crudo.str.to_lowercase().is_in(['none', 'nan', ''])).then(pl.lit(hoy))
+        .otherwise(pl.coalesce(iso, fs).str.to_date(DATE_FORMAT, strict=False, exact=False))
+        .alias(col)
+    )
+
+def normalizar_estado(col: str = 'estado') -> pl.Expr:
+    """Expresión a ESTADO_ENUM: cualquier valor nulo o fuera de ESTADOS queda como 'pendiente'."""
+    e = pl.col(col).cast(pl.Utf8).str.strip_chars().str.to_lowercase()
+    return pl.when(e.is_in(ESTADOS)).then(e).otherwise(pl.lit('pendiente')).cast(ESTADO_ENUM).alias(col)
+
+def normalizar_booleano(col: str, dtype: pl.DataType) -> pl.Expr:
+    """Expresión a pl.Boolean según TRUE_VALUES; las celdas numéricas (calamine puede dar 1.0) valen True si != 0."""
+    if dtype.is_numeric(): return (pl.col(col) != 0).alias(col)
+    return pl.col(col).cast(pl.Utf8).str.strip_chars().str.to_lowercase().is_in(TRUE_VALUES).alias(col)
 
 def procesar_archivo_inteligente(uploaded_file):
+    # El uploader conserva el archivo entre reruns: solo se procesa una vez
+    if st.session_state.get('import_procesado') == uploaded_file.file_id: return
     try:
-        raw_content = uploaded_file.getvalue()
+        uploaded_file.seek(0)  # UploadedFile ya es un BytesIO: se lee sin copiarlo
         nombre = uploaded_file.name.lower()
-        hoy = datetime.now().strftime(DATE_FORMAT)
+        hoy = date.today()
         
-        # 1. Carga inicial según formato
+        # 1. Carga inicial según formato (todo el pipeline es lazy hasta el collect final, que corre en streaming)
         if nombre.endswith('.csv'):
-            df = pl.read_csv(io.BytesIO(raw_content), infer_schema_length=10000)
-            if 'NORMALIZADO' in df.columns:
-                df = df.with_columns(pl.col('NORMALIZADO').cast(pl.Utf8).str.to_lowercase().is_in(TRUE_VALUES).cast(pl.Int64))
-            df = df.rename({k: v for k, v in CSV_TO_DB_MAPPING.items() if k in df.columns})
+            lf = pl.scan_csv(uploaded_file, schema_overrides=CSV_SCHEMA, infer_schema_length=0)
+            lf = lf.rename({k: v for k, v in CSV_TO_DB_MAPPING.items() if k in lf.collect_schema().names()})
             
         elif nombre.endswith('.ods'):
-            with io.BytesIO(raw_content) as bio:
-                # Leemos con pandas
-                pd_df = pd.read_excel(bio, engine='odf')
-                
-                # SOLUCIÓN: Convertir todo el dataframe de pandas a string 
-                # para evitar conflictos de tipos con Arrow/Polars
-                pd_df = pd_df.astype(str).replace('nan', None) 
-                
-                df = pl.from_pandas(pd_df)
+            # calamine (fastexcel) tipa cada columna y la deja directo en Arrow, sin pandas/odfpy
+            lf = pl.read_ods(uploaded_file).lazy()
+            lf = lf.rename({k: v for k, v in ODS_TO_DB_MAPPING.items() if k in lf.collect_schema().names()})
 
         # --- Lógica de Mapeo de Columna "X" ---
         # Buscamos si existe una columna que se llame exactamente "X" (independientemente de mayúsculas/minúsculas)
-        col_x = next((c for c in df.columns if c.upper() == 'X'), None)
+        col_x = next((c for c in lf.collect_schema().names() if c.upper() == 'X'), None)
         
         if col_x:
             # Definimos el mapeo (incluyendo el vacío como pendiente)
-            # Usamos replace para mayor velocidad en Polars
-            df = df.with_columns(
-                pl.col(col_x).cast(pl.Utf8).fill_null('')
-                .str.strip_chars()
-                .replace(ODS_ESTADO_MAP, default='pendiente')
+            # replace_strict resuelve todo el mapeo en un único lookup vectorizado; los nulos caen en el default
+            lf = lf.with_columns(
+                pl.col(col_x).cast(pl.Utf8)
+                .str.strip_chars().str.to_lowercase()
+                .replace_strict(ODS_ESTADO_MAP, default='pendiente', return_dtype=pl.Utf8)
                 .alias('estado')
             )
             # Eliminamos la columna original "X" si no se llama "estado"
             if col_x != 'estado':
-                df = df.drop(col_x)
+                lf = lf.drop(col_x)
             
             # Renombrar el resto de columnas según el mapping
-            df = df.rename({k: v for k, v in CSV_TO_DB_MAPPING.items() if k in df.columns})
+            lf = lf.rename({k: v for k, v in CSV_TO_DB_MAPPING.items() if k in lf.collect_schema().names()})
+
+        schema = lf.collect_schema()
+        cols = schema.names()
 
+        # Estado, flag y fechas en un solo with_columns: Polars evalúa todas las expresiones en una pasada
         # --- Lógica de Estado Final (Seguridad) ---
-        if 'estado' not in df.columns:
-            df = df.with_columns(pl.lit('pendiente').alias('estado'))
-        else:
-            # Asegurar que cualquier valor nulo o no mapeado sea 'pendiente'
-            df = df.with_columns(pl.col('estado').fill_null('pendiente'))
+        # Asegurar que cualquier valor nulo o no mapeado sea 'pendiente'
+        exprs = [normalizar_estado() if 'estado' in cols else pl.lit('pendiente').alias('estado')]
 
         # --- Resto del procesamiento ---
-        if 'fecha_intervencion' not in df.columns:
-            df = df.with_columns(pl.lit(hoy).alias('fecha_intervencion'))
+        # Misma prueba de TRUE_VALUES para NORMALIZADO (CSV) y N (ODS)
+        if 'normalizado' in cols:
+            exprs.append(normalizar_booleano('normalizado', schema['normalizado']))
+
+        if 'fecha_intervencion' in cols:
+            exprs.append(pl.col('fecha_intervencion').cast(pl.Utf8).str.to_date(DATE_FORMAT, strict=False, exact=False))
+        else:
+            exprs.append(pl.lit(hoy).alias('fecha_intervencion'))
 
-        if 'fecha_alta' in df.columns:
-            df = df.with_columns(pl.col('fecha_alta').map_elements(normalizar_fecha, return_dtype=pl.Utf8))
+        if 'fecha_alta' in cols:
+            exprs.append(normalizar_fecha('fecha_alta', hoy))
+
+        lf = lf.with_columns(exprs)
 
         # Asegurar esquema y tipos
-        for col, dtype in FINAL_SCHEMA.items():
-            if col not in df.columns: 
-                df = df.with_columns(pl.lit(None).cast(dtype).alias(col))
+        cols = lf.collect_schema().names()
+        lf = lf.with_columns([pl.lit(None).cast(dtype).alias(col) for col, dtype in FINAL_SCHEMA.items() if col not in cols])
         
-        df = df.select([pl.col(c).cast(FINAL_SCHEMA[c]) for c in FINAL_SCHEMA.keys()])
+        df = lf.select(FINAL_SCHEMA.keys()).cast(FINAL_SCHEMA).collect(engine="streaming")
 
-        # Actualizar Session State
-        if len(st.session_state.data) > 0:
-            st.session_state.data = pl.concat([st.session_state.data, df], how="vertical").unique(subset=['nro_cli'], keep='last')
+        # Actualizar Session State: lo importado pisa a lo existente con el mismo nro_cli
+        df = df.unique(subset=['nro_cli'], keep='last', maintain_order=True)
+        if not st.session_state.data.is_empty():
+            existentes = st.session_state.data.join(df.select('nro_cli'), on='nro_cli', how='anti')
+            st.session_state.data = pl.concat([existentes, df], how="vertical")
         else:
             st.session_state.data = df
 
+        st.session_state.import_procesado = uploaded_file.file_id
         st.success(f"{len(df)} {'fila procesada' if len(df) == 1 else 'filas procesadas'}.")
         st.rerun()
 
     except Exception as e:
         st.error(f"Error: {e}")
 
+# Huella barata del contenido: evita reconstruir el ZIP en reruns donde los datos no cambiaron
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs={pl.DataFrame: lambda d: (d.height, d.hash_rows().sum())})
 def exportar_todo(df):
+    # Formato de persistencia, común a la DB y al CSV
+    df_out = df.select(SQLITE_SCHEMA.keys()).cast(SQLITE_SCHEMA)
+
     # 1. DB SQLite
     conn_mem = sqlite3.connect(':memory:')
-    df.to_pandas().to_sql('desvinculados', conn_mem, if_exists='replace', index=False)
-    tmp_path = f"/tmp/{uuid.uuid4()}.db"
-    with sqlite3.connect(tmp_path) as disk_conn: conn_mem.backup(disk_conn)
-    with open(tmp_path, "rb") as f: db_bytes = f.read()
-    os.remove(tmp_path)
+    conn_mem.executescript("PRAGMA journal_mode=OFF; PRAGMA synchronous=OFF; PRAGMA temp_store=MEMORY; PRAGMA cache_size=-64000; PRAGMA page_size=65536;")
+    columnas = ', '.join(f'"{c}" {"TEXT" if t == pl.Utf8 else "INTEGER"}' for c, t in SQLITE_SCHEMA.items())
+    with conn_mem:  # una sola transacción para todo el insert
+        conn_mem.execute(f"CREATE TABLE desvinculados ({columnas})")
+        conn_mem.executemany(f"INSERT INTO desvinculados VALUES ({', '.join('?' * len(SQLITE_SCHEMA))})", df_out.iter_rows())
+    db_bytes = conn_mem.serialize()
+    conn_mem.close()
 
     # 2. CSV con Mapper
-    df_csv = df.clone()
-    rename_map = {col: mapper.get_csv_col(col) for col in df_csv.columns if not mapper.get_csv_col(col).startswith("MISSING_")}
-    csv_bytes = df_csv.rename(rename_map).write_csv().encode('utf-8')
+    rename_map = {col: mapper.get_csv_col(col) for col in df_out.columns if not mapper.get_csv_col(col).startswith("MISSING_")}
+    csv_bytes = df_out.rename(rename_map).write_csv().encode('utf-8')
 
-    # 3. ZIP
+    # 3. ZIP (sin compresión: las páginas SQLite comprimen poco y DEFLATE domina el tiempo)
     zip_buf = io.BytesIO()
-    with zipfile.ZipFile(zip_buf, "w") as zf:
+    with zipfile.ZipFile(zip_buf, "w", compression=zipfile.ZIP_STORED) as zf:
         zf.writestr("desvinculados.db", db_bytes)
         zf.writestr("desvinculados.csv", csv_bytes)
     return zip_buf.getvalue()
 
 def cargar_db(uploaded_file):
-    """Carga DB de disco a Polars DataFrame en memoria."""
-    conn = None
-    conn_disk = None
-    temp_file_path = None
-    
-    db_bytes = uploaded_file.read()
-    
+    """Carga la DB subida directo a una SQLite en memoria y de ahí a Polars."""
+    # Ya cargada en un rerun anterior: no se vuelve a parsear ni se pisan los cambios
+    if st.session_state.get('db_cargada') == uploaded_file.file_id: return
+    conn = sqlite3.connect(':memory:')
     try:
-        temp_path = f"/tmp/{uuid.uuid4()}.db"
-        with open(temp_path, "wb") as f: f.write(uploaded_file.getvalue())
-        conn = sqlite3.connect(temp_path)
-        st.session_state.data = pl.read_database("SELECT * FROM desvinculados", conn)
-        conn.close()
-        os.remove(temp_path)
+        with uploaded_file.getbuffer() as buf: conn.deserialize(buf)
+        df = pl.read_database("SELECT * FROM desvinculados", conn, schema_overrides=SQLITE_SCHEMA)
+        df = df.with_columns([pl.col(c).str.to_date(DATE_FORMAT, strict=False) for c in ['fecha_intervencion', 'fecha_alta']] + [normalizar_estado()])
+        # Las DB viejas pueden traer nro_cli repetidos: se conserva la última aparición
+        st.session_state.data = df.select(FINAL_SCHEMA.keys()).cast(FINAL_SCHEMA).unique(subset=['nro_cli'], keep='last', maintain_order=True)
+        st.session_state.db_cargada = uploaded_file.file_id
         st.success("Base de datos cargada.")
     except Exception as e: st.error(f"Error DB: {e}")
+    finally: conn.close()
 
 # ==============================================================================
 # 3. INTERFAZ
 # ==============================================================================
 
 st.set_page_config(layout="wide", page_title="Desvinculados EPE", page_icon="⚡")
-if 'data' not in st.session_state: st.session_state.data = pl.DataFrame({}, schema=FINAL_SCHEMA)
+if 'data' not in st.session_state: st.session_state.data = pl.DataFrame(schema=FINAL_SCHEMA)
 
 st.title("⚡ EPE - Gestión de Desvinculados")
 
@@ -235,24 +277,24 @@ with t1:
         f_in = st.file_uploader("📥 Importar CSV/ODS", type=['csv', 'ods'])
         if f_in: procesar_archivo_inteligente(f_in)
 
-    if len(st.session_state.data) > 0:
+    if not st.session_state.data.is_empty():
         st.divider()
         filtro = st.selectbox("Vista:", FILTRO_OPTIONS, index=2)
-        df_v = st.session_state.data.clone()
-        if filtro != "Todos los registros": df_v = df_v.filter(pl.col('estado') == filtro)
+        df_v = st.session_state.data if filtro == "Todos los registros" else st.session_state.data.filter(pl.col('estado') == filtro)
 
-        pdf = df_v.to_pandas()
-        for c in ['fecha_intervencion', 'fecha_alta']: pdf[c] = pd.to_datetime(pdf[c], errors='coerce').dt.date
-        
-        edited = st.data_editor(pdf, column_config={
+        edited = st.data_editor(df_v, column_config={
             "estado": st.column_config.SelectboxColumn("estado", options=ESTADOS, required=True),
             # "fecha_intervencion": st.column_config.DateColumn("fecha_intervencion", format="YYYY-MM-DD")
-            "fecha_intervencion": st.column_config.DateColumn("fecha_intervencion", format="DD-MM-YYYY")
+            "fecha_intervencion": st.column_config.DateColumn("fecha_intervencion", format="DD-MM-YYYY"),
+            "fecha_alta": st.column_config.DateColumn("fecha_alta", format="DD-MM-YYYY")
         }, disabled=('nro_med', 'usuario', 'domicilio', 'normalizado', 'fecha_alta'), num_rows='dynamic', hide_index=True)
 
         if st.button("💾 Aplicar cambios"):
-            res = pl.from_pandas(edited).with_columns([pl.col(c).cast(pl.Utf8) for c in ['fecha_intervencion', 'fecha_alta']])
-            st.session_state.data = pl.concat([st.session_state.data.filter(~pl.col('nro_cli').is_in(res['nro_cli'])), res], how="vertical").filter(pl.col('nro_cli').is_not_null())
+            # El editor devuelve enteros con nulos como float y fechas como datetime
+            res = edited.select(FINAL_SCHEMA.keys()).cast(FINAL_SCHEMA).unique(subset=['nro_cli'], keep='last', maintain_order=True)
+            # Mismo merge que la importación: un anti-join no multiplica nro_cli repetidos como lo haría un update
+            existentes = st.session_state.data.join(res.select('nro_cli'), on='nro_cli', how='anti')
+            st.session_state.data = pl.concat([existentes, res], how="vertical").filter(pl.col('nro_cli').is_not_null())
             st.success("Guardado.")
             st.rerun()
 